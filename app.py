@@ -1,9 +1,7 @@
-from flask import Flask, render_template, request, send_file, jsonify
+from flask import Flask, render_template, request, send_file, jsonify, Response
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import os
-from werkzeug.utils import secure_filename
-import pandas as pd
-from src.dxf_manipulator import duplicate_entities
-import ezdxf
+from src.dxf_manipulator import duplicate_entities, load_order_data, output_filename, DEFAULT_TEMPLATE, OUTPUT_FORMATS
 from ezdxf.addons.drawing import RenderContext, Frontend
 from ezdxf.addons.drawing.matplotlib import MatplotlibBackend
 import matplotlib.pyplot as plt
@@ -17,7 +15,11 @@ from logging.handlers import RotatingFileHandler
 import tempfile
 from functools import wraps
 import time
+import threading
+import zlib
 from src.progress_tracker import progress_tracker
+from src.workspace import WorkspaceManager, WorkspaceQuotaExceeded
+from src.memory_monitor import MemoryMonitor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,7 +28,10 @@ handler = RotatingFileHandler('app.log', maxBytes=10000, backupCount=3)
 logger.addHandler(handler)
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['WORKSPACE_ROOT'] = os.environ.get('WORKSPACE_ROOT')  # Defaults to tmpfs when available
+app.config['WORKSPACE_QUOTA_BYTES'] = int(os.environ.get('WORKSPACE_QUOTA_MB', 1024)) * 1024 * 1024
+app.config['WORKSPACE_TTL_SECONDS'] = int(os.environ.get('WORKSPACE_TTL_SECONDS', 3600))
+app.config['MEMORY_BUDGET_BYTES'] = int(os.environ.get('MEMORY_BUDGET_MB', 0)) * 1024 * 1024  # 0 disables the budget
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['CACHE_TYPE'] = 'simple'
 app.config['CACHE_DEFAULT_TIMEOUT'] = 300
@@ -40,11 +45,48 @@ limiter = Limiter(
     storage_uri="memory://"
 )
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
 ALLOWED_EXTENSIONS = {'dxf', 'xlsx', 'xls'}
 
+PREVIEW_SIZE_INCHES = 12
+PREVIEW_DPI = 300
+LOW_MEMORY_PREVIEW_DPI = 100
+# RGBA canvas plus the copies made while encoding the PNG
+PREVIEW_BYTES_PER_PIXEL = 12
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Formats that are already compressed and are never gzip-encoded again on download
+COMPRESSED_SUFFIXES = ('.gz', '.zip')
+DOWNLOAD_MIMETYPES = {
+    '.dxf': 'application/x-dxf',
+    '.gz': 'application/gzip',
+    '.zip': 'application/zip'
+}
+
+# Per-job transfer statistics keyed by job id
+transfer_stats = {}
+transfer_stats_lock = threading.Lock()
+
+def record_transfer(job_id, **counts):
+    with transfer_stats_lock:
+        stats = transfer_stats.get(job_id)
+        if stats is None:
+            return
+        for key, value in counts.items():
+            stats[key] += value
+
+def forget_transfer_stats(job_id):
+    with transfer_stats_lock:
+        transfer_stats.pop(job_id, None)
+
+# Each job gets a private workspace directory, evicted after the TTL or when over quota
+workspaces = WorkspaceManager(
+    root=app.config['WORKSPACE_ROOT'],
+    quota_bytes=app.config['WORKSPACE_QUOTA_BYTES'],
+    ttl_seconds=app.config['WORKSPACE_TTL_SECONDS'],
+    on_evict=forget_transfer_stats
+)
+workspaces.start()
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -58,8 +100,16 @@ def timing_decorator(f):
         return result
     return wrap
 
+def preview_dpi(memory_monitor):
+    """Use a lower preview resolution when the full-size figure would not fit the memory budget"""
+    pixels = (PREVIEW_SIZE_INCHES * PREVIEW_DPI) ** 2
+    if memory_monitor.low_memory or not memory_monitor.fits(pixels * PREVIEW_BYTES_PER_PIXEL):
+        memory_monitor.enter_low_memory('full-resolution preview does not fit the memory budget')
+        return LOW_MEMORY_PREVIEW_DPI
+    return PREVIEW_DPI
+
 @timing_decorator
-def dxf_to_image(doc):
+def dxf_to_image(doc, dpi=PREVIEW_DPI):
     # progress_tracker.update(0.8, 'Generating preview image...')
     tmp_file = None
     
@@ -68,7 +118,7 @@ def dxf_to_image(doc):
         msp = doc.modelspace()
         
         # Create figure with optimal settings
-        fig = plt.figure(figsize=(12, 12), dpi=300)
+        fig = plt.figure(figsize=(PREVIEW_SIZE_INCHES, PREVIEW_SIZE_INCHES), dpi=dpi)
         ax = plt.axes([0, 0, 1, 1])
         
         logger.info("Setting up rendering context")
@@ -102,7 +152,7 @@ def dxf_to_image(doc):
                 format='png',
                 bbox_inches='tight',
                 pad_inches=0,
-                dpi=300,
+                dpi=dpi,
                 facecolor='white',
                 transparent=False
             )
@@ -134,37 +184,30 @@ def dxf_to_image(doc):
         plt.close('all')
 
 @timing_decorator
-def process_files(excel_path, logo_path):
+def process_files(excel_path, logo_path, workspace, output_format='dxf', memory_monitor=None):
     try:
         # Read Excel file in a memory-efficient way
         logger.info(f"Reading Excel file: {excel_path}")
-        df = pd.read_excel(excel_path, engine='openpyxl')
-        
-        # Ensure required columns exist
-        required_columns = ['Name', 'Quantity', 'Category']
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = ''  # Add empty column if it doesn't exist
-                if col == 'Quantity':
-                    df[col] = 1  # Default quantity to 1
-                if col == 'Category':
-                    df[col] = 'Default'  # Default category
-        
-        data_df = df[required_columns]
+        if memory_monitor:
+            memory_monitor.stage('read_excel')
+        data_df = load_order_data(excel_path)
         logger.info(f"Found {len(data_df)} entries in Excel file")
         
-        template_path = 'public/dxf_template/template.dxf'
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], 'output.dxf')
+        template_path = DEFAULT_TEMPLATE
+        output_path = workspace.file_path(output_filename('output', output_format))
         
         if logo_path:
             logger.info("Processing with logo")
-            duplicate_entities(template_path, output_path, logo_path, data_df)
+            doc = duplicate_entities(template_path, output_path, logo_path, data_df, output_format, memory_monitor)
         else:
             logger.info("Processing without logo")
-            duplicate_entities(template_path, output_path, None, data_df)
+            doc = duplicate_entities(template_path, output_path, None, data_df, output_format, memory_monitor)
+        
+        if doc is None:
+            raise Exception("No entities found to duplicate in template")
             
         logger.info(f"Successfully created output file: {output_path}")
-        return output_path
+        return output_path, doc
         
     except Exception as e:
         logger.error(f"Error in process_files: {str(e)}")
@@ -222,60 +265,90 @@ def upload_file():
                     return jsonify({'error': 'Invalid logo file type'}), 400
                 logger.info(f"Processing logo file: {logo_file.filename}")
 
+        output_format = request.form.get('outputFormat', 'dxf')
+        if output_format not in OUTPUT_FORMATS:
+            logger.error(f"Invalid output format: {output_format}")
+            return jsonify({'error': 'Invalid output format. Allowed formats are: ' + ', '.join(OUTPUT_FORMATS)}), 400
+
         progress_tracker.update(0.1, 'Saving files...')
 
-        # Ensure upload directory exists
-        if not os.path.exists(app.config['UPLOAD_FOLDER']):
-            os.makedirs(app.config['UPLOAD_FOLDER'])
-            logger.info(f"Created upload directory: {app.config['UPLOAD_FOLDER']}")
+        # Create a private workspace for this job
+        try:
+            workspace = workspaces.create()
+            logger.info(f"Created workspace for job {workspace.job_id}: {workspace.path}")
+        except WorkspaceQuotaExceeded as e:
+            logger.error(f"Error creating workspace: {str(e)}")
+            progress_tracker.update(1.0, f'Error: {str(e)}')
+            return jsonify({'error': str(e)}), 507
 
         # Save files with secure filenames
         try:
-            excel_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(excel_file.filename))
+            excel_path = workspace.file_path(excel_file.filename)
             excel_file.save(excel_path)
             logger.info(f"Saved excel file to: {excel_path}")
 
             if logo_file and logo_file.filename != '':
-                logo_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(logo_file.filename))
+                logo_path = workspace.file_path(logo_file.filename)
                 logo_file.save(logo_path)
                 logger.info(f"Saved logo file to: {logo_path}")
         except Exception as e:
             logger.error(f"Error saving files: {str(e)}")
+            workspaces.remove(workspace.job_id)
             progress_tracker.update(1.0, f'Error: {str(e)}')
             return jsonify({'error': f'Error saving files: {str(e)}'}), 500
 
         progress_tracker.update(0.15, 'Processing files...')
 
+        memory_monitor = MemoryMonitor(app.config['MEMORY_BUDGET_BYTES'])
         try:
             # Process the files and generate preview
-            output_path = process_files(excel_path, logo_path)
+            output_path, doc = process_files(excel_path, logo_path, workspace, output_format, memory_monitor)
             logger.info(f"Generated output file at: {output_path}")
             
             progress_tracker.update(0.85, 'Generating preview...')
             
-            # Generate preview image
-            doc = ezdxf.readfile(output_path)
-            preview_base64 = dxf_to_image(doc)
+            # Generate preview image from the in-memory document
+            memory_monitor.stage('preview')
+            preview_base64 = dxf_to_image(doc, dpi=preview_dpi(memory_monitor))
+            memory_monitor.finish()
             
             progress_tracker.update(1.0, 'Complete!')
             logger.info("File processing completed successfully")
             
-            # Get the output filename
-            output_filename = os.path.basename(output_path)
+            # Get the output filename and size
+            output_name = os.path.basename(output_path)
+            bytes_written = os.path.getsize(output_path)
+            workspaces.finish(workspace.job_id)
+            with transfer_stats_lock:
+                transfer_stats[workspace.job_id] = {'bytes_written': bytes_written, 'bytes_sent': 0, 'downloads': 0}
+            logger.info(f"Wrote {bytes_written} bytes to {output_name}")
             
             return jsonify({
                 'preview': preview_base64,
                 'message': 'Files processed successfully',
-                'filename': output_filename,
+                'job_id': workspace.job_id,
+                'filename': output_name,
+                'format': output_format,
+                'bytes_written': bytes_written,
+                'memory': memory_monitor.report(),
                 'progress': 1.0,
                 'complete': True
             })
             
+        except WorkspaceQuotaExceeded as e:
+            logger.error(f"Error storing output: {str(e)}")
+            progress_tracker.update(1.0, f'Error: {str(e)}')
+            return jsonify({'error': str(e)}), 507
+            
         except Exception as e:
             error_msg = str(e)
             logger.error(f"Error processing files: {error_msg}")
+            workspaces.remove(workspace.job_id)
             progress_tracker.update(1.0, f'Error: {error_msg}')
             return jsonify({'error': f'Error processing files: {error_msg}'}), 500
+        
+        finally:
+            memory_monitor.finish()
             
     except Exception as e:
         error_msg = str(e)
@@ -283,23 +356,95 @@ def upload_file():
         progress_tracker.update(1.0, f'Error: {error_msg}')
         return jsonify({'error': f'Unexpected error: {error_msg}'}), 500
 
-@app.route('/download/<filename>')
-def download_file(filename):
+def stream_gzip(file_path, job_id):
+    """Yield a file gzip-encoded in chunks and record the bytes sent"""
+    sent = 0
+    compressor = zlib.compressobj(wbits=31)  # wbits=31 -> gzip container
+    try:
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunk = compressor.compress(chunk)
+                if chunk:
+                    sent += len(chunk)
+                    yield chunk
+            chunk = compressor.flush()
+            sent += len(chunk)
+            yield chunk
+        record_transfer(job_id, downloads=1)
+    finally:
+        record_transfer(job_id, bytes_sent=sent)
+        logger.info(f"Sent {sent} bytes of {os.path.basename(file_path)} for job {job_id} (gzip)")
+
+@app.route('/download/<job_id>/<filename>')
+def download_file(job_id, filename):
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        workspace = workspaces.get(job_id)
+        if workspace is None:
+            return jsonify({'error': 'File not found'}), 404
+        file_path = workspace.file_path(filename)
+        filename = os.path.basename(file_path)  # The sanitized name that was looked up
         
         if not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 404
-            
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/x-dxf'
-        )
+        
+        stat = os.stat(file_path)
+        mimetype = DOWNLOAD_MIMETYPES.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
+        
+        # Compress on the fly when the client accepts gzip, the file is not already
+        # compressed and no byte range was asked for
+        if not request.range and request.accept_encodings['gzip'] \
+                and not filename.lower().endswith(COMPRESSED_SUFFIXES):
+            response = Response(mimetype=mimetype, headers={
+                'Content-Disposition': f'attachment; filename="{filename}"',
+                'Content-Encoding': 'gzip',
+                'Vary': 'Accept-Encoding'
+            })
+            response.last_modified = stat.st_mtime
+            response.set_etag(f'{stat.st_mtime}-{stat.st_size}-gzip')
+            response.make_conditional(request)
+            # Attach the stream only when the body is actually sent (not on 304)
+            if response.status_code == 200:
+                response.response = stream_gzip(file_path, job_id)
+                response.headers.pop('Content-Length', None)
+            return response
+        
+        # send_file sets ETag and Last-Modified; make_conditional answers 304, If-Range and
+        # single byte ranges (206/416). Multi-range requests get the full file, as RFC 9110 allows.
+        response = send_file(file_path, mimetype=mimetype, as_attachment=True, download_name=filename,
+                             conditional=False, etag=True)
+        response.headers['Vary'] = 'Accept-Encoding'
+        environ = request.environ
+        if request.range and len(request.range.ranges) > 1:
+            environ = {key: value for key, value in environ.items() if key != 'HTTP_RANGE'}
+        response.make_conditional(environ, accept_ranges=True, complete_length=stat.st_size)
+        
+        # Only complete transfers count as downloads; resumed or segmented ones add bytes only
+        if response.status_code in (200, 206):
+            record_transfer(job_id, bytes_sent=response.content_length or 0,
+                            downloads=1 if response.status_code == 200 else 0)
+        return response
+    except RequestedRangeNotSatisfiable as e:
+        return e.get_response()
     except Exception as e:
         return jsonify({'error': f'Error downloading file: {str(e)}'}), 500
 
+@app.route('/stats/<job_id>')
+@limiter.exempt
+def get_transfer_stats(job_id):
+    with transfer_stats_lock:
+        stats = transfer_stats.get(job_id)
+        if stats is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(dict(stats, job_id=job_id))
+
+@app.route('/metrics/workspace')
+@limiter.exempt
+def get_workspace_metrics():
+    return jsonify(workspaces.metrics())
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,326 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from src.memory_monitor import MemoryMonitor
+from src.dxf_manipulator import (
+    duplicate_entities, load_order_data, output_filename, DEFAULT_TEMPLATE, OUTPUT_FORMATS
+)
+
+logger = logging.getLogger(__name__)
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+LOGO_SUFFIX = '_logo.dxf'
+TEMPLATE_SUFFIX = '_template.dxf'
+STATE_FILENAME = 'batch_state.json'
+REPORT_FILENAME = 'batch_report.csv'
+REPORT_COLUMNS = ['order', 'status', 'entries', 'read_seconds', 'generate_seconds',
+                  'total_seconds', 'bytes_written', 'peak_rss_bytes', 'low_memory', 'output', 'error']
+
+def discover_orders(input_dir, default_logo=None, default_template=DEFAULT_TEMPLATE):
+    """
+    Build the order list from a directory of spreadsheets.
+
+    Every .xlsx/.xls file is one order named after its stem. A sibling
+    `<stem>_logo.dxf` or `<stem>_template.dxf` overrides the default logo or template.
+    """
+    orders = []
+    for filename in sorted(os.listdir(input_dir)):
+        stem, ext = os.path.splitext(filename)
+        if ext.lower() not in EXCEL_EXTENSIONS or filename.startswith('~$'):
+            continue
+
+        logo_path = os.path.join(input_dir, stem + LOGO_SUFFIX)
+        template_path = os.path.join(input_dir, stem + TEMPLATE_SUFFIX)
+        orders.append({
+            'order': stem,
+            'excel': os.path.join(input_dir, filename),
+            'logo': logo_path if os.path.exists(logo_path) else default_logo,
+            'template': template_path if os.path.exists(template_path) else default_template
+        })
+    check_unique_orders(orders, 'input directory')
+    return orders
+
+def read_manifest(manifest_path, default_logo=None, default_template=DEFAULT_TEMPLATE):
+    """
+    Build the order list from a CSV manifest.
+
+    Required column: excel. Optional columns: order, logo, template.
+    Relative paths are resolved against the manifest's directory.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    def resolve(value):
+        value = (value or '').strip()
+        if not value:
+            return None
+        return value if os.path.isabs(value) else os.path.join(base_dir, value)
+
+    orders = []
+    with open(manifest_path, newline='', encoding='utf-8') as f:
+        for line_no, row in enumerate(csv.DictReader(f), 2):
+            excel_path = resolve(row.get('excel'))
+            if not excel_path:
+                raise ValueError(f"Manifest line {line_no} has no 'excel' path")
+
+            order_id = (row.get('order') or '').strip() or os.path.splitext(os.path.basename(excel_path))[0]
+            orders.append({
+                'order': order_id,
+                'excel': excel_path,
+                'logo': resolve(row.get('logo')) or default_logo,
+                'template': resolve(row.get('template')) or default_template
+            })
+
+    check_unique_orders(orders, 'manifest')
+    return orders
+
+def check_unique_orders(orders, source):
+    """Order ids name the output and state entries, so they must be unique"""
+    seen = {}
+    for order in orders:
+        if order['order'] in seen:
+            raise ValueError(f"Duplicate order id in {source}: {order['order']} "
+                             f"({seen[order['order']]} and {order['excel']})")
+        seen[order['order']] = order['excel']
+
+def new_result(order, output_dir, output_format='dxf'):
+    """Return the initial (failed) result record for an order"""
+    return {
+        'order': order['order'],
+        'status': 'failed',
+        'entries': 0,
+        'read_seconds': 0.0,
+        'generate_seconds': 0.0,
+        'total_seconds': 0.0,
+        'bytes_written': 0,
+        'peak_rss_bytes': 0,
+        'low_memory': False,
+        'output': os.path.join(output_dir, output_filename(order['order'], output_format)),
+        'error': ''
+    }
+
+def process_order(order, output_dir, output_format='dxf', memory_budget_bytes=None, trace_memory=False,
+                  started_marker=None):
+    """
+    Generate the DXF for a single order. Runs in a worker process and never raises.
+
+    If `started_marker` is given, that file is created first so the parent can tell a
+    started order from a queued one if the worker process dies.
+    """
+    if started_marker:
+        open(started_marker, 'w').close()
+    result = new_result(order, output_dir, output_format)
+    output_path = result['output']
+
+    # Each worker runs one order at a time, so per-stage tracemalloc peaks belong to this order
+    memory_monitor = MemoryMonitor(memory_budget_bytes, trace=trace_memory, exclusive=True)
+    start = time.time()
+    try:
+        memory_monitor.stage('read_excel')
+        data_df = load_order_data(order['excel'])
+        result['entries'] = len(data_df)
+        result['read_seconds'] = round(time.time() - start, 3)
+
+        generate_start = time.time()
+        doc = duplicate_entities(order['template'], output_path, order['logo'], data_df, output_format,
+                                 memory_monitor)
+        result['generate_seconds'] = round(time.time() - generate_start, 3)
+
+        if doc is None:
+            raise RuntimeError('No entities found to duplicate in template')
+        result['bytes_written'] = os.path.getsize(output_path)
+        result['status'] = 'ok'
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {str(e)}"
+        result['traceback'] = traceback.format_exc()
+    finally:
+        memory_monitor.finish()
+
+    result['memory'] = memory_monitor.report()
+    result['peak_rss_bytes'] = memory_monitor.peak_rss_bytes
+    result['low_memory'] = memory_monitor.low_memory
+    result['total_seconds'] = round(time.time() - start, 3)
+    return result
+
+def load_state(state_path):
+    """Load the results of a previous run, keyed by order id"""
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_state(state_path, state):
+    """Persist results atomically so an interrupted run can be resumed"""
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+def write_report(report_path, results):
+    """Write per-order status and timing as CSV"""
+    with open(report_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+def run_batch(orders, output_dir, workers=None, resume=True, output_format='dxf',
+              memory_budget_bytes=None, trace_memory=False):
+    """
+    Process orders across a process pool.
+
+    Args:
+        orders: List of order dicts with order, excel, logo and template keys
+        output_dir: Directory receiving the generated files, the state file and the report
+        workers: Number of worker processes (defaults to the CPU count)
+        resume: Skip orders that completed successfully in a previous run
+        output_format: One of OUTPUT_FORMATS
+        memory_budget_bytes: Per-order memory budget; each worker runs one order at a time
+        trace_memory: Also record per-stage Python allocation peaks with tracemalloc
+
+    Returns:
+        list: One result dict per order, in input order
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, STATE_FILENAME)
+    state = load_state(state_path) if resume else {}
+
+    pending = []
+    for order in orders:
+        previous = state.get(order['order'])
+        expected_output = os.path.join(output_dir, output_filename(order['order'], output_format))
+        if previous and previous['status'] == 'ok' and previous['output'] == expected_output \
+                and os.path.exists(expected_output):
+            logger.info(f"Skipping completed order: {order['order']}")
+            continue
+        pending.append(order)
+
+    logger.info(f"Processing {len(pending)} of {len(orders)} orders with {workers or os.cpu_count()} workers")
+    batch_start = time.time()
+
+    done = 0
+
+    def record(result):
+        nonlocal done
+        done += 1
+        state[result['order']] = result
+        save_state(state_path, state)
+
+        if result['status'] == 'ok':
+            logger.info(f"[{done}/{len(pending)}] {result['order']} done in {result['total_seconds']:.2f} seconds")
+        else:
+            logger.error(f"[{done}/{len(pending)}] {result['order']} failed: {result['error']}")
+
+    def crash_result(order):
+        result = new_result(order, output_dir, output_format)
+        result['error'] = 'Worker process died while processing this order'
+        return result
+
+    def run_pool(batch, max_workers, markers_dir):
+        """
+        Run orders in one pool.
+
+        Returns:
+            tuple: Orders that were running when a worker process died, and orders
+            that had not started yet
+        """
+        running, not_started = [], []
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for index, order in enumerate(batch):
+                marker = os.path.join(markers_dir, str(index))
+                futures[executor.submit(process_order, order, output_dir, output_format,
+                                        memory_budget_bytes, trace_memory, marker)] = (order, marker)
+            for future in as_completed(futures):
+                order, marker = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    # The pool fails every pending future; the start marker tells which had started
+                    (running if os.path.exists(marker) else not_started).append(order)
+                    continue
+                except Exception as e:
+                    result = new_result(order, output_dir, output_format)
+                    result['error'] = f"{type(e).__name__}: {str(e)}"
+                record(result)
+        return running, not_started
+
+    remaining = pending
+    while remaining:
+        with tempfile.TemporaryDirectory() as markers_dir:
+            running, remaining = run_pool(remaining, workers, markers_dir)
+        if not running:
+            continue
+
+        logger.warning(f"A worker process died with {len(running)} orders running; "
+                       f"resubmitting {len(remaining)} orders that had not started")
+        if len(running) == 1:
+            record(crash_result(running[0]))
+            continue
+
+        # Retry each order that was running in its own worker to find the one that crashed
+        for order in running:
+            with tempfile.TemporaryDirectory() as markers_dir:
+                crashed, unstarted = run_pool([order], 1, markers_dir)
+            if crashed or unstarted:
+                record(crash_result(order))
+
+    results = [state[order['order']] for order in orders if order['order'] in state]
+    write_report(os.path.join(output_dir, REPORT_FILENAME), results)
+
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    bytes_written = sum(result.get('bytes_written', 0) for result in results)
+    logger.info(f"Batch finished in {time.time() - batch_start:.2f} seconds: "
+                f"{len(results) - failed} succeeded, {failed} failed, {bytes_written} bytes written")
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Generate DXF files for a batch of order spreadsheets.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input-dir', help=f'Directory of order spreadsheets (optional <order>{LOGO_SUFFIX} and <order>{TEMPLATE_SUFFIX} alongside)')
+    source.add_argument('--manifest', help='CSV manifest with columns excel[, order, logo, template]')
+    parser.add_argument('--output-dir', required=True, help='Directory for generated DXF files and reports')
+    parser.add_argument('--logo', default=None, help='Default logo DXF for orders without their own')
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE, help='Default template DXF for orders without their own')
+    parser.add_argument('--format', dest='output_format', choices=list(OUTPUT_FORMATS), default='dxf',
+                        help='Output format (default: dxf)')
+    parser.add_argument('--memory-budget-mb', type=int, default=0,
+                        help='Per-order memory budget; orders approaching it switch to lower-memory generation')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Record per-stage Python allocation peaks with tracemalloc (slower)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--no-resume', action='store_true', help='Reprocess orders that already completed')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = parse_args(argv)
+
+    try:
+        if args.manifest:
+            orders = read_manifest(args.manifest, args.logo, args.template)
+        else:
+            orders = discover_orders(args.input_dir, args.logo, args.template)
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+
+    if not orders:
+        logger.error('No orders found')
+        return 1
+
+    results = run_batch(orders, args.output_dir, workers=args.workers, resume=not args.no_resume,
+                        output_format=args.output_format,
+                        memory_budget_bytes=args.memory_budget_mb * 1024 * 1024,
+                        trace_memory=args.trace_memory)
+    return 0 if all(result['status'] == 'ok' for result in results) else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,3 +1,8 @@
+import gc
+import gzip
+import io
+import os
+import zipfile
 import ezdxf
 from ezdxf.addons import text2path
 from ezdxf import bbox, path
@@ -6,6 +11,7 @@ from ezdxf.addons.importer import Importer
 from ezdxf.math import Matrix44
 import pandas as pd
 from src.progress_tracker import progress_tracker
+from src.memory_monitor import MemoryMonitor
 
 # Constants
 # logo size = 18.5%
@@ -13,6 +19,70 @@ LOGO_SIZE_RATIO = 0.185
 ROW_X_OFFSET = 5.5
 ROW_Y_OFFSET = 1.4
 SPACING = 0.2
+DEFAULT_TEMPLATE = 'public/dxf_template/template.dxf'
+REQUIRED_COLUMNS = ['Name', 'Quantity', 'Category']
+# Text outline flattening (distance, segments); the low-memory setting emits about half the vertices
+TEXT_FLATTENING = (0.001, 2)
+LOW_MEMORY_TEXT_FLATTENING = (0.005, 1)
+# Templates per layout row; the memory budget is checked once per row
+TEMPLATES_PER_ROW = 10
+# Output format -> file extension
+OUTPUT_FORMATS = {
+    'dxf': '.dxf',
+    'binary': '.dxf',
+    'gzip': '.dxf.gz',
+    'zip': '.zip'
+}
+
+def load_order_data(excel_path):
+    """Read an order spreadsheet and return its Name, Quantity and Category columns"""
+    df = pd.read_excel(excel_path, engine='openpyxl')
+    
+    # Ensure required columns exist
+    for col in REQUIRED_COLUMNS:
+        if col not in df.columns:
+            df[col] = ''  # Add empty column if it doesn't exist
+            if col == 'Quantity':
+                df[col] = 1  # Default quantity to 1
+            if col == 'Category':
+                df[col] = 'Default'  # Default category
+    
+    return df[REQUIRED_COLUMNS]
+
+def output_filename(base_name, output_format='dxf'):
+    """Return the file name for a generated document in the given output format"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}. Allowed formats are: {', '.join(OUTPUT_FORMATS)}")
+    return base_name + OUTPUT_FORMATS[output_format]
+
+def save_document(doc, target_file, output_format='dxf'):
+    """
+    Save document as ASCII DXF, binary DXF, gzip-compressed DXF or a ZIP archive.
+    
+    Args:
+        doc: ezdxf document
+        target_file: Target file path
+        output_format: One of OUTPUT_FORMATS
+    
+    Returns:
+        int: Number of bytes written to disk
+    """
+    if output_format == 'dxf':
+        doc.saveas(target_file)
+    elif output_format == 'binary':
+        doc.saveas(target_file, fmt='bin')
+    elif output_format == 'gzip':
+        with gzip.open(target_file, 'wt', encoding=doc.output_encoding, errors='dxfreplace') as stream:
+            doc.write(stream)
+    elif output_format == 'zip':
+        member_name = os.path.splitext(os.path.basename(target_file))[0] + '.dxf'
+        with zipfile.ZipFile(target_file, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(member_name, 'w') as member:
+                with io.TextIOWrapper(member, encoding=doc.output_encoding, errors='dxfreplace') as stream:
+                    doc.write(stream)
+    else:
+        raise ValueError(f"Unknown output format: {output_format}. Allowed formats are: {', '.join(OUTPUT_FORMATS)}")
+    return os.path.getsize(target_file)
 
 def get_font_face(style="Calisto"):
     """Get font face based on style with fallback"""
@@ -164,8 +234,9 @@ def process_path_vertices(text_path, offset_x=0, offset_y=0, distance=0.005, seg
                     result.append(translated)
     return result
 
-def add_text_to_entity(msp, text, center_x, center_y, text_height, style="Calisto", logo_exist=False, TEXT_CENTER_OFFSET = 0):
-    """Add text to entity using text path"""
+def add_text_to_entity(msp, text, center_x, center_y, text_height, style="Calisto", logo_exist=False, TEXT_CENTER_OFFSET = 0,
+                       flattening=TEXT_FLATTENING):
+    """Add text to entity using text path, flattened with the given (distance, segments)"""
     font_face = get_font_face(style)
     
     # Create text path
@@ -194,7 +265,7 @@ def add_text_to_entity(msp, text, center_x, center_y, text_height, style="Calist
         offset_y = center_y - text_center_y
         
         # Create polylines with offset
-        for vertices in process_path_vertices(text_path, offset_x, offset_y, distance=0.001, segments=2):
+        for vertices in process_path_vertices(text_path, offset_x, offset_y, distance=flattening[0], segments=flattening[1]):
             polyline = msp.add_polyline2d(vertices)
             polyline.dxf.color = 3
 
@@ -276,7 +347,7 @@ def insert_logo(doc, logo_file, entity_extents, scale_factor=0.75):
         print(f"Error processing logo file: {e}")
         return
 
-def duplicate_entities(source_file, target_file, logo_file, data_df):
+def duplicate_entities(source_file, target_file, logo_file, data_df, output_format='dxf', memory_monitor=None):
     """
     Duplicate entities based on DataFrame containing Name, Quantity, and Category columns.
     Empty templates will be added between different categories and to reach next multiple of 10.
@@ -287,8 +358,18 @@ def duplicate_entities(source_file, target_file, logo_file, data_df):
         target_file: Target DXF file path
         logo_file: Logo file path (optional)
         data_df: DataFrame with columns: Name, Quantity, Category
+        output_format: One of OUTPUT_FORMATS (default: ASCII DXF)
+        memory_monitor: MemoryMonitor recording per-stage peaks (optional). If it has a
+            budget and the projected usage approaches it, the remaining templates are
+            emitted with coarser text flattening and garbage collected per row.
+    
+    Returns:
+        Drawing: The generated document, or None if the template has no entities
     """
+    monitor = memory_monitor or MemoryMonitor()
+    
     progress_tracker.update(0.15, 'Preparing template list...')
+    monitor.stage('plan')
     
     # Create list of all positions (filled and empty)
     full_template_list = []
@@ -345,6 +426,7 @@ def duplicate_entities(source_file, target_file, logo_file, data_df):
             current_col += 1
 
     progress_tracker.update(0.3, 'Loading source file...')
+    monitor.stage('load_template')
     
     # Load and prepare source file
     doc = ezdxf.readfile(source_file)
@@ -355,7 +437,8 @@ def duplicate_entities(source_file, target_file, logo_file, data_df):
     original_extents = bbox.extents(original_entities)
     if not original_extents:
         print("No entities found to duplicate")
-        return
+        monitor.end_stage()
+        return None
     
     dims = calculate_dimensions(original_extents)
     base_x = original_extents.extmin[0]
@@ -364,6 +447,8 @@ def duplicate_entities(source_file, target_file, logo_file, data_df):
     logo_exist = bool(logo_file)
     
     progress_tracker.update(0.35, 'Processing first template...')
+    monitor.stage('generate')
+    flattening = LOW_MEMORY_TEXT_FLATTENING if monitor.check_budget() else TEXT_FLATTENING
     
     # Process original entity (first template)
     first_template = full_template_list[0]
@@ -373,11 +458,20 @@ def duplicate_entities(source_file, target_file, logo_file, data_df):
         if logo_exist:
             insert_logo(doc, logo_file, original_extents)
         
-        add_text_to_entity(msp, first_template['name'], dims['center_x'], dims['center_y'], dims['text_height'], "Calisto", logo_exist)
+        add_text_to_entity(msp, first_template['name'], dims['center_x'], dims['center_y'], dims['text_height'], "Calisto", logo_exist,
+                           flattening=flattening)
     
     # Process remaining templates
     total_templates = len(full_template_list[1:])
+    baseline_rss = monitor.sample()
     for i, template in enumerate(full_template_list[1:], 1):
+        # Sample RSS and check the budget at the start of each layout row (separators and
+        # padding occupy slots too) and free transient objects in low-memory mode
+        if i % TEMPLATES_PER_ROW == 0:
+            if monitor.check_budget(i, total_templates, baseline_rss):
+                gc.collect()
+        flattening = LOW_MEMORY_TEXT_FLATTENING if monitor.low_memory else TEXT_FLATTENING
+        
         progress = 0.35 + (0.45 * (i / total_templates))
         progress_tracker.update(progress, f'Processing template {i} of {total_templates + 1}')
         
@@ -397,19 +491,19 @@ def duplicate_entities(source_file, target_file, logo_file, data_df):
                 current_extents = bbox.extents(current_entities)
                 insert_logo(doc, logo_file, current_extents)
                 
-            add_text_to_entity(msp, template['name'], current_center_x, current_center_y, dims['text_height'], "Calisto", logo_exist)
+            add_text_to_entity(msp, template['name'], current_center_x, current_center_y, dims['text_height'], "Calisto", logo_exist,
+                               flattening=flattening)
     
     progress_tracker.update(0.8, 'Saving file...')
-    doc.saveas(target_file)
+    monitor.stage('save')
+    bytes_written = save_document(doc, target_file, output_format)
+    monitor.end_stage()
     
     progress_tracker.update(0.85, 'Complete!')
     print(f"Created {len(data_df)} templates with {len(full_template_list) - len(data_df)} empty templates to reach {len(full_template_list)} total templates")
+    print(f"Wrote {bytes_written} bytes to {target_file}")
+    return doc
 
 if __name__ == "__main__":
-    source_file = "test.dxf"
-    target_file = "textpath_r12.dxf"
-    logo_file = "logo-untar.dxf"
-    # logo_file = ""
-    df = pd.read_excel("test-nama.xlsx", engine='openpyxl')
-    data_df = df[['Name', 'Quantity', 'Category']]
-    duplicate_entities(source_file, target_file, logo_file, data_df)
+    from src.batch_processor import main
+    raise SystemExit(main())
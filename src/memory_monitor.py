@@ -0,0 +1,173 @@
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Fraction of the budget at which the engine switches to lower-memory strategies
+SOFT_LIMIT_RATIO = 0.8
+# Seconds between background RSS samples while a stage is open
+SAMPLE_INTERVAL = 0.1
+
+def current_rss():
+    """Return the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is the peak rather than the current RSS, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def start_tracing():
+    """Start tracemalloc for the rest of the process. It is never stopped by a monitor."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+class MemoryMonitor:
+    """
+    Track peak memory per generation stage and enforce an optional per-job budget.
+
+    RSS is sampled at stage boundaries, by a background thread every `sample_interval`
+    seconds while a stage is open, and whenever `sample()` is called. The budget
+    applies to the job's own growth, i.e. RSS above what the process used when the
+    monitor was created, so memory held by the idle server does not count against it.
+
+    With `trace=True` the peak of Python allocations per stage is also recorded via
+    tracemalloc, at a noticeable speed cost. tracemalloc is process-wide and its peak
+    can only be reset for everyone, so tracing requires an `exclusive` monitor (one
+    job per process, as in batch workers) and is ignored otherwise. RSS also covers
+    the whole process, so under a threaded server it includes concurrent jobs.
+    """
+
+    def __init__(self, budget_bytes=None, trace=False, exclusive=False, sample_interval=SAMPLE_INTERVAL):
+        self.budget_bytes = budget_bytes or None
+        self.sample_interval = sample_interval
+        self.trace = trace and exclusive
+        self.exclusive = exclusive
+        self.low_memory = False
+        self.low_memory_reason = ''
+        self.stages = []
+        self._current = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self.baseline_rss_bytes = current_rss()
+
+        if self.trace:
+            start_tracing()
+
+    def stage(self, name):
+        """End the current stage, if any, and start a new one"""
+        self.end_stage()
+        rss = current_rss()
+        if self.trace:
+            tracemalloc.reset_peak()
+        with self._lock:
+            self._current = {
+                'name': name,
+                'start': time.time(),
+                'rss_start_bytes': rss,
+                'peak_rss_bytes': rss
+            }
+        if self.sample_interval and self._sampler is None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='memory-sampler', daemon=True)
+            self._sampler.start()
+
+    def end_stage(self):
+        if self._current is None:
+            return
+        rss = self.sample()
+        with self._lock:
+            stage, self._current = self._current, None
+        stage['seconds'] = round(time.time() - stage.pop('start'), 3)
+        stage['rss_end_bytes'] = rss
+        if self.trace:
+            stage['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        self.stages.append(stage)
+        logger.info(f"Stage {stage['name']} took {stage['seconds']:.2f} seconds, "
+                    f"peak RSS {stage['peak_rss_bytes'] / 1024 / 1024:.1f} MB")
+
+    def finish(self):
+        """End the last stage and stop the background sampler"""
+        self.end_stage()
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.sample_interval):
+            self.sample()
+
+    def sample(self):
+        """Sample the current RSS, update the stage peak and return it"""
+        rss = current_rss()
+        with self._lock:
+            if self._current is not None and rss > self._current['peak_rss_bytes']:
+                self._current['peak_rss_bytes'] = rss
+        return rss
+
+    def job_bytes(self):
+        """RSS growth since the monitor was created"""
+        return max(self.sample() - self.baseline_rss_bytes, 0)
+
+    def fits(self, extra_bytes):
+        """Whether allocating `extra_bytes` more stays below the soft limit of the budget"""
+        if not self.budget_bytes:
+            return True
+        return self.job_bytes() + extra_bytes <= self.budget_bytes * SOFT_LIMIT_RATIO
+
+    def check_budget(self, done=0, total=0, baseline_rss=None):
+        """
+        Switch to low-memory mode when the budget is at risk.
+
+        If progress is given, the RSS growth per item since `baseline_rss` is
+        extrapolated to the remaining items.
+
+        RSS is sampled on every call, so callers also get stage peaks without a budget.
+
+        Returns:
+            bool: Whether low-memory mode is active
+        """
+        rss = self.sample()
+        if not self.budget_bytes or self.low_memory:
+            return self.low_memory
+
+        projected = max(rss - self.baseline_rss_bytes, 0)
+        if baseline_rss is not None and done > 0:
+            projected += max(rss - baseline_rss, 0) / done * (total - done)
+
+        if projected > self.budget_bytes * SOFT_LIMIT_RATIO:
+            self.enter_low_memory(f"projected job memory {projected / 1024 / 1024:.0f} MB "
+                                  f"exceeds {SOFT_LIMIT_RATIO:.0%} of {self.budget_bytes / 1024 / 1024:.0f} MB budget")
+        return self.low_memory
+
+    def enter_low_memory(self, reason):
+        if self.low_memory:
+            return
+        self.low_memory = True
+        self.low_memory_reason = reason
+        stage = self._current['name'] if self._current else 'none'
+        logger.warning(f"Switching to low-memory mode during stage {stage}: {reason}")
+
+    @property
+    def peak_rss_bytes(self):
+        peaks = [stage['peak_rss_bytes'] for stage in self.stages]
+        if self._current is not None:
+            peaks.append(self._current['peak_rss_bytes'])
+        return max(peaks, default=current_rss())
+
+    def report(self):
+        return {
+            'budget_bytes': self.budget_bytes,
+            'low_memory': self.low_memory,
+            'low_memory_reason': self.low_memory_reason,
+            'baseline_rss_bytes': self.baseline_rss_bytes,
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'peak_job_bytes': max(self.peak_rss_bytes - self.baseline_rss_bytes, 0),
+            'stages': list(self.stages)
+        }
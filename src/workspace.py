@@ -0,0 +1,243 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+logger = logging.getLogger(__name__)
+
+TMPFS_ROOT = '/dev/shm'
+WORKSPACE_DIRNAME = 'dxf_duplicator'
+# Share of the free space the quota may claim, leaving headroom for anything else on the filesystem
+DISK_CAPACITY_RATIO = 0.9
+
+class WorkspaceQuotaExceeded(Exception):
+    """Raised when a job cannot fit within the workspace quota"""
+
+class Workspace:
+    def __init__(self, job_id, path):
+        self.job_id = job_id
+        self.path = path
+        self.created = time.time()
+        self.last_access = self.created
+        self.size = 0
+        self.active = True
+
+    def file_path(self, filename):
+        """Return the path of a file inside this workspace, with a sanitized filename"""
+        return os.path.join(self.path, secure_filename(filename))
+
+def filesystem_capacity(root):
+    """
+    Return the bytes workspaces under `root` may use: what they already hold there
+    plus a share of the filesystem's free space. `root` need not exist yet.
+    """
+    existing = directory_size(root) if os.path.isdir(root) else 0
+    probe = root if os.path.isdir(root) else os.path.dirname(root)
+    return existing + int(shutil.disk_usage(probe).free * DISK_CAPACITY_RATIO)
+
+def default_root(quota_bytes):
+    """
+    Prefer tmpfs for fast, memory-backed I/O and fall back to the system temp directory.
+
+    tmpfs is often small (64 MB in Docker by default) and counts against container
+    memory, so it is only used when it can hold the whole quota.
+    """
+    if os.path.isdir(TMPFS_ROOT) and os.access(TMPFS_ROOT, os.W_OK):
+        tmpfs_root = os.path.join(TMPFS_ROOT, WORKSPACE_DIRNAME)
+        if filesystem_capacity(tmpfs_root) >= quota_bytes:
+            return tmpfs_root
+        logger.info(f"{TMPFS_ROOT} has less free space than the workspace quota, using the system temp directory")
+    return os.path.join(tempfile.gettempdir(), WORKSPACE_DIRNAME)
+
+def directory_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+class WorkspaceManager:
+    """
+    Gives each job a private directory and keeps total disk usage bounded.
+
+    Workspaces are active while their job runs and are never evicted then. Finished
+    workspaces are evicted when idle for longer than `ttl_seconds`, or least recently
+    used first when the total size would exceed `quota_bytes`.
+    """
+
+    def __init__(self, root=None, quota_bytes=1024 * 1024 * 1024, ttl_seconds=3600,
+                 sweep_interval=60, on_evict=None):
+        self.root = root or default_root(quota_bytes)
+        self.quota_bytes = quota_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self.on_evict = on_evict
+        self._workspaces = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.evicted_jobs = 0
+        self.evicted_bytes = 0
+
+        os.makedirs(self.root, exist_ok=True)
+
+        # A quota larger than the free space would fail with ENOSPC before any eviction happens
+        capacity = filesystem_capacity(self.root)
+        if self.quota_bytes > capacity:
+            logger.warning(f"Workspace quota {quota_bytes} bytes exceeds the space available in {self.root}, "
+                           f"capping it at {capacity} bytes")
+            self.quota_bytes = capacity
+        logger.info(f"Workspace root: {self.root} (effective quota {self.quota_bytes} bytes, TTL {self.ttl_seconds}s)")
+
+        self._adopt_leftovers()
+
+    def create(self):
+        """Create a new active workspace, evicting idle ones if the quota is already used up"""
+        with self._lock:
+            self._evict_expired()
+            self._evict_to_fit()
+            if self._live_bytes() >= self.quota_bytes:
+                raise WorkspaceQuotaExceeded('Workspace storage is full, please try again later')
+
+            job_id = uuid.uuid4().hex
+            path = os.path.join(self.root, job_id)
+            os.makedirs(path)
+            workspace = Workspace(job_id, path)
+            self._workspaces[job_id] = workspace
+            return workspace
+
+    def get(self, job_id):
+        """Return the workspace for a job and mark it as recently used, or None"""
+        with self._lock:
+            workspace = self._workspaces.get(job_id)
+            if workspace:
+                workspace.last_access = time.time()
+            return workspace
+
+    def finish(self, job_id):
+        """
+        Mark a job as finished and account for the files it wrote.
+
+        Idle workspaces are evicted to make room. If the job alone does not fit
+        within the quota, its workspace is removed and WorkspaceQuotaExceeded is raised.
+        """
+        with self._lock:
+            workspace = self._workspaces.get(job_id)
+            if not workspace:
+                return
+            workspace.active = False
+            workspace.last_access = time.time()
+            workspace.size = directory_size(workspace.path)
+
+            self._evict_to_fit(keep=job_id)
+            if self._live_bytes() > self.quota_bytes:
+                self._evict(workspace)
+                raise WorkspaceQuotaExceeded(
+                    f'Job output ({workspace.size} bytes) does not fit within the workspace quota')
+
+    def remove(self, job_id):
+        """Delete a workspace immediately, e.g. after a failed job"""
+        with self._lock:
+            workspace = self._workspaces.pop(job_id, None)
+        if workspace:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+
+    def sweep(self):
+        """Evict workspaces that have been idle for longer than the TTL"""
+        with self._lock:
+            return self._evict_expired()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'root': self.root,
+                'tmpfs': self.root.startswith(TMPFS_ROOT + os.sep),
+                'quota_bytes': self.quota_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'live_jobs': len(self._workspaces),
+                'active_jobs': sum(1 for workspace in self._workspaces.values() if workspace.active),
+                'live_bytes': self._live_bytes(),
+                'evicted_jobs': self.evicted_jobs,
+                'evicted_bytes': self.evicted_bytes
+            }
+
+    def start(self):
+        """Start the background TTL eviction thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='workspace-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                evicted = self.sweep()
+                if evicted:
+                    logger.info(f"Evicted {evicted} expired workspaces")
+            except Exception as e:
+                logger.error(f"Error sweeping workspaces: {str(e)}")
+
+    def _adopt_leftovers(self):
+        # Job directories left by a previous process are tracked as finished workspaces,
+        # so they count against the quota and are evicted like any other
+        with self._lock:
+            for entry in os.scandir(self.root):
+                if not entry.is_dir() or len(entry.name) != 32 or entry.name in self._workspaces:
+                    continue
+                workspace = Workspace(entry.name, entry.path)
+                workspace.active = False
+                workspace.size = directory_size(entry.path)
+                workspace.last_access = entry.stat().st_mtime
+                self._workspaces[entry.name] = workspace
+            if self._workspaces:
+                logger.info(f"Adopted {len(self._workspaces)} workspaces left by a previous process "
+                            f"({self._live_bytes()} bytes)")
+            self._evict_expired()
+            self._evict_to_fit()
+
+    def _live_bytes(self):
+        # Active workspaces are still being written, so measure them on disk
+        return sum(directory_size(workspace.path) if workspace.active else workspace.size
+                   for workspace in self._workspaces.values())
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        expired = [workspace for workspace in self._workspaces.values()
+                   if not workspace.active and workspace.last_access < cutoff]
+        for workspace in expired:
+            self._evict(workspace)
+        return len(expired)
+
+    def _evict_to_fit(self, keep=None):
+        idle = sorted((workspace for workspace in self._workspaces.values()
+                       if not workspace.active and workspace.job_id != keep),
+                      key=lambda workspace: workspace.last_access)
+        live_bytes = self._live_bytes()
+        for workspace in idle:
+            if live_bytes <= self.quota_bytes:
+                break
+            live_bytes -= workspace.size
+            self._evict(workspace)
+
+    def _evict(self, workspace):
+        self._workspaces.pop(workspace.job_id, None)
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        self.evicted_jobs += 1
+        self.evicted_bytes += workspace.size
+        logger.info(f"Evicted workspace {workspace.job_id} ({workspace.size} bytes)")
+        if self.on_evict:
+            self.on_evict(workspace.job_id)